@@ -11,12 +11,37 @@ from __future__ import annotations
 import json
 import math
 import os
+import queue
 import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Any, Iterator, Optional
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional speed-up; stdlib json is the fallback
+    orjson = None
+
+
+if orjson is not None:
+
+    def _json_loads(text: str | bytes) -> Any:
+        return orjson.loads(text)
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+else:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
 
 
 # ── Data classes ──────────────────────────────────────────────────────────────
@@ -75,93 +100,345 @@ class TaskTrace:
 # ── Helpers ───────────────────────────────────────────────────────────────────
 
 
-def _estimate_tokens(text: str) -> int:
-    return max(1, math.ceil(len(text) / 3.5))
+def _estimate_tokens(n_chars: int) -> int:
+    return max(1, math.ceil(n_chars / 3.5))
+
+
+def _estimate_node_tokens(node: sqlite3.Row) -> int:
+    """Token estimate of the lines ``SQLiteGraph._format_node`` emits, joined by newlines."""
+    # Header line: "## {name}  <{type}>" plus " [{file}]"
+    n_chars = len(node["name"]) + len(node["node_type"] or "node") + 7
+    if node["file"]:
+        n_chars += len(node["file"]) + 3
+    # Each optional section adds its text plus the joining newlines
+    if node["signature"]:
+        n_chars += len(node["signature"]) + 18
+    if node["roxygen_text"]:
+        n_chars += min(len(node["roxygen_text"]), 400) + 20
+    if node["body_text"]:
+        n_chars += min(len(node["body_text"]), 1200) + 10
+    return _estimate_tokens(n_chars)
+
+
+def _trigrams(text: str) -> set[str]:
+    text = text.lower()
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+_NON_TOKEN_RE = re.compile(r"[^a-z0-9_.]")
 
 
-def _tokenize(text: str) -> list[str]:
-    return [t for t in re.sub(r"[^a-z0-9_.]", " ", text.lower()).split() if len(t) > 1]
+@lru_cache(maxsize=4096)
+def _tokenize(text: str) -> tuple[str, ...]:
+    # Tuple so cached results cannot be mutated by callers
+    return tuple(t for t in _NON_TOKEN_RE.sub(" ", text.lower()).split() if len(t) > 1)
 
 
-def _cosine(a: list[float], b: list[float]) -> float:
-    min_len = min(len(a), len(b))
-    if min_len == 0:
-        return 0.0
-    dot = sum(a[i] * b[i] for i in range(min_len))
-    norm_a = math.sqrt(sum(x * x for x in a[:min_len]))
-    norm_b = math.sqrt(sum(x * x for x in b[:min_len]))
-    denom = norm_a * norm_b
-    return dot / denom if denom > 0 else 0.0
+def _batched(items: list[str]) -> Iterator[list[str]]:
+    for i in range(0, len(items), _SQL_MAX_PARAMS):
+        yield items[i : i + _SQL_MAX_PARAMS]
+
+
+def _unit_embedding(text: str) -> Optional[np.ndarray]:
+    """Parse a JSON embedding into a unit-length float32 vector, or None if malformed."""
+    try:
+        emb = np.asarray(_json_loads(text), dtype=np.float32)
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return None
+    if emb.ndim != 1:
+        return None
+    norm = float(np.sqrt(np.vdot(emb, emb)))
+    return emb / norm if norm > 0 else emb
+
+
+def _score(sem: np.ndarray, pr: np.ndarray, tw: np.ndarray, depth: np.ndarray) -> np.ndarray:
+    """Blend semantic, pagerank, task-weight and BFS-depth signals per candidate."""
+    return 0.4 * sem + 0.35 * pr + 0.15 * tw + 0.1 * (1 / (1 + depth * 0.5))
+
+
+# ── SQL ───────────────────────────────────────────────────────────────────────
+# Hoisted so every call passes the same string to sqlite3's statement cache.
+
+_SQL_GET_METAS = "SELECT key, value FROM graph_metadata WHERE key IN ({})"
+
+_SQL_SET_META = (
+    "INSERT INTO graph_metadata(key, value) VALUES(?,?) "
+    "ON CONFLICT(key) DO UPDATE SET value=excluded.value"
+)
+
+# graph_metadata "embedding_blob_format" value for unit-length float32 blobs
+_EMBEDDING_BLOB_FORMAT = "unit-f32"
+
+# Per-type node and edge counts for get_graph_summary in one statement
+_SQL_TYPE_COUNTS = (
+    "SELECT 'node', node_type, COUNT(*) FROM nodes GROUP BY node_type "
+    "UNION ALL "
+    "SELECT 'edge', edge_type, COUNT(*) FROM edges GROUP BY edge_type"
+)
+
+_SQL_FIND_BY_NAME = "SELECT node_id FROM nodes WHERE name = ? LIMIT 1"
+
+_SQL_NODE_BY_NAME = "SELECT * FROM nodes WHERE name = ? LIMIT 1"
+
+# Callers, callees and tests in one round trip; each leg keeps its own
+# LIMIT 20 and the kind column says which list a row belongs to
+_SQL_NODE_EDGES = """
+SELECT * FROM (
+  SELECT 'caller' AS kind, n.name FROM edges e JOIN nodes n ON n.node_id = e.source_id
+  WHERE e.target_id = :node_id AND e.edge_type = 'CALLS' LIMIT 20
+)
+UNION ALL
+SELECT * FROM (
+  SELECT 'callee' AS kind, n.name FROM edges e JOIN nodes n ON n.node_id = e.target_id
+  WHERE e.source_id = :node_id AND e.edge_type = 'CALLS' LIMIT 20
+)
+UNION ALL
+SELECT * FROM (
+  SELECT 'test' AS kind, n.name FROM edges e JOIN nodes n ON n.node_id = e.source_id
+  WHERE e.target_id = :node_id AND e.edge_type = 'TESTS' LIMIT 20
+)
+"""
+
+_SQL_FILE_NODES = "SELECT * FROM nodes WHERE file = ? OR file LIKE ?"
+
+# BFS expansion and candidate fetch; "{}" is filled with one "?" per id
+# (edge targets that have no nodes row are still traversed but never returned)
+_SQL_BFS_NEIGHBOURS = (
+    "SELECT DISTINCT e.target_id, n.node_id IS NOT NULL FROM edges e "
+    "LEFT JOIN nodes n ON n.node_id = e.target_id WHERE e.source_id IN ({})"
+)
+
+_SQL_BFS_NODES = (
+    "SELECT node_id, name, file, node_type, signature, roxygen_text, body_text, "
+    "pagerank, task_weight, embedding_blob, "
+    "CASE WHEN embedding_blob IS NULL THEN embedding END AS embedding "
+    "FROM nodes WHERE node_id IN ({})"
+)
+
+# Keeps IN lists under SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds
+_SQL_MAX_PARAMS = 500
+
+# Traces store a Unix epoch in milliseconds; SQLite derives the ISO-8601
+# created_at read by the TypeScript server and R package from it
+_SQL_INSERT_TRACE = (
+    "INSERT INTO task_traces(query, nodes_json, polarity, session_id, created_at_epoch, created_at) "
+    "VALUES(?1, ?2, ?3, ?4, ?5, strftime('%Y-%m-%dT%H:%M:%fZ', ?5 / 1000.0, 'unixepoch'))"
+)
+
+# Per-connection prepared-statement cache (sqlite3 default is 128)
+_CACHED_STATEMENTS = 256
+
+# Default reader pool cap: each reader carries its own 64 MiB page cache and
+# 256 MiB mmap window, so one per core is too much on large machines
+_MAX_DEFAULT_READERS = 4
+
+# Entries kept in each of the query_context / get_node_info result caches
+_RESULT_CACHE_SIZE = 64
 
 
 # ── SQLiteGraph ───────────────────────────────────────────────────────────────
 
 
 class SQLiteGraph:
-    def __init__(self, db_path: str) -> None:
+    def __init__(self, db_path: str, pool_size: Optional[int] = None) -> None:
         self._db_path = str(Path(db_path).resolve())
-        self._conn = sqlite3.connect(self._db_path)
-        self._conn.row_factory = sqlite3.Row
-        self._conn.execute("PRAGMA journal_mode=WAL")
-        self._conn.execute("PRAGMA foreign_keys=ON")
+        # One writer behind a lock; WAL lets the read-only pool below keep
+        # serving concurrent tool handlers while it commits
+        self._writer = sqlite3.connect(
+            self._db_path, check_same_thread=False, cached_statements=_CACHED_STATEMENTS
+        )
+        self._writer.row_factory = sqlite3.Row
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA foreign_keys=ON")
+        self._tune(self._writer)
+        self._write_lock = threading.Lock()
         self._ensure_schema()
+        self._migrate_embeddings()
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+        ro_uri = f"{Path(self._db_path).as_uri()}?mode=ro"
+        for _ in range(pool_size or min(_MAX_DEFAULT_READERS, os.cpu_count() or 1)):
+            conn = sqlite3.connect(
+                ro_uri, uri=True, check_same_thread=False, cached_statements=_CACHED_STATEMENTS
+            )
+            conn.row_factory = sqlite3.Row
+            self._tune(conn)
+            self._readers.put(conn)
         self._vocab: dict[str, tuple[float, int, int]] = {}
+        self._trigrams: dict[str, set[str]] = {}
         self._load_vocab()
+        # LRU result caches; entries carry the _db_stamp() they were built
+        # under so a commit from another connection (e.g. an R re-export)
+        # retires them
+        self._cache_lock = threading.Lock()
+        self._context_cache: OrderedDict[tuple, tuple[int, ContextResult]] = OrderedDict()
+        self._node_cache: OrderedDict[tuple, tuple[int, Optional[NodeInfo]]] = OrderedDict()
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Check out a read-only connection from the pool."""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Hold the single writer connection exclusively."""
+        with self._write_lock:
+            yield self._writer
+
+    # ── Result caches ─────────────────────────────────────────────────────────
+
+    def _db_stamp(self) -> int:
+        # data_version only moves when another connection commits, so this
+        # server's own task traces keep cached results; reload() clears the
+        # caches after its own schema and embedding writes
+        with self.writer() as conn:
+            return conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _cache_get(self, cache: OrderedDict, key: tuple, stamp: int) -> tuple[bool, Any]:
+        with self._cache_lock:
+            entry = cache.get(key)
+            if entry is None or entry[0] != stamp:
+                return False, None
+            cache.move_to_end(key)
+            return True, entry[1]
+
+    def _cache_put(self, cache: OrderedDict, key: tuple, stamp: int, value: Any) -> None:
+        with self._cache_lock:
+            cache[key] = (stamp, value)
+            cache.move_to_end(key)
+            if len(cache) > _RESULT_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    @staticmethod
+    def _tune(conn: sqlite3.Connection) -> None:
+        # Serve pages from a 256 MiB mmap window and a 64 MiB page cache
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Keep dirty pages in memory until commit instead of spilling mid-transaction
+        conn.execute("PRAGMA cache_spill=OFF")
 
     # ── Schema ────────────────────────────────────────────────────────────────
 
     def _ensure_schema(self) -> None:
-        schema_path = Path(__file__).parent.parent / "src" / "db" / "schema.sql"
-        if schema_path.exists():
-            sql = schema_path.read_text(encoding="utf-8")
-            # Execute statement by statement, skipping failures (triggers may
-            # already exist; FTS virtual tables may not be supported)
-            for stmt in sql.split(";"):
-                stmt = stmt.strip()
-                if stmt:
-                    try:
-                        self._conn.execute(stmt)
-                    except sqlite3.OperationalError:
-                        pass
-            self._conn.commit()
+        with self.writer() as conn:
+            schema_path = Path(__file__).parent.parent / "src" / "db" / "schema.sql"
+            if schema_path.exists():
+                sql = schema_path.read_text(encoding="utf-8")
+                # Execute statement by statement, skipping failures (triggers may
+                # already exist; FTS virtual tables may not be supported)
+                for stmt in sql.split(";"):
+                    stmt = stmt.strip()
+                    if stmt:
+                        try:
+                            conn.execute(stmt)
+                        except sqlite3.OperationalError:
+                            pass
+                conn.commit()
+            for ddl in (
+                # Python-side cache of parsed embeddings (unit float32 bytes)
+                "ALTER TABLE nodes ADD COLUMN embedding_blob BLOB",
+                # Rewriting the JSON embedding in place invalidates its blob
+                "CREATE TRIGGER IF NOT EXISTS nodes_embedding_blob_reset "
+                "AFTER UPDATE OF embedding ON nodes WHEN old.embedding IS NOT new.embedding "
+                "BEGIN UPDATE nodes SET embedding_blob = NULL WHERE rowid = new.rowid; END",
+                # Covering indexes so edge lookups in get_node_info and the BFS
+                # never touch the edges table itself
+                "CREATE INDEX IF NOT EXISTS idx_edges_src_type_tgt ON edges(source_id, edge_type, target_id)",
+                "CREATE INDEX IF NOT EXISTS idx_edges_tgt_type_src ON edges(target_id, edge_type, source_id)",
+                "CREATE INDEX IF NOT EXISTS idx_nodes_name ON nodes(name)",
+                "CREATE INDEX IF NOT EXISTS idx_nodes_file ON nodes(file)",
+                "CREATE INDEX IF NOT EXISTS idx_nodes_pagerank ON nodes(pagerank DESC)",
+                "ALTER TABLE task_traces ADD COLUMN created_at_epoch INTEGER",
+            ):
+                try:
+                    conn.execute(ddl)
+                except sqlite3.OperationalError:
+                    pass
+            conn.commit()
+
+    def _migrate_embeddings(self) -> None:
+        """Populate ``embedding_blob`` for nodes not converted yet.
+
+        Blobs hold the unit-length embedding. Blobs written before the
+        current format are all rebuilt from the JSON column.
+        """
+        with self.writer() as conn:
+            try:
+                current = self._get_metas(conn, "embedding_blob_format").get("embedding_blob_format")
+                if current == _EMBEDDING_BLOB_FORMAT:
+                    sql = (
+                        "SELECT node_id, embedding FROM nodes "
+                        "WHERE embedding IS NOT NULL AND embedding_blob IS NULL"
+                    )
+                else:
+                    sql = "SELECT node_id, embedding FROM nodes WHERE embedding IS NOT NULL"
+                updates = []
+                for row in conn.execute(sql).fetchall():
+                    unit = _unit_embedding(row["embedding"])
+                    if unit is not None:
+                        updates.append((unit.tobytes(), row["node_id"]))
+                if updates:
+                    conn.executemany("UPDATE nodes SET embedding_blob = ? WHERE node_id = ?", updates)
+                if current != _EMBEDDING_BLOB_FORMAT:
+                    conn.execute(_SQL_SET_META, ("embedding_blob_format", _EMBEDDING_BLOB_FORMAT))
+                conn.commit()
+            except sqlite3.OperationalError:
+                # Graph not exported yet and no schema.sql to create the tables
+                conn.rollback()
 
     def _load_vocab(self) -> None:
-        try:
-            cur = self._conn.execute("SELECT term, idf, doc_count, term_count FROM tfidf_vocab")
-            self._vocab = {row["term"]: (row["idf"], row["doc_count"], row["term_count"]) for row in cur}
-        except sqlite3.OperationalError:
-            pass
+        with self.reader() as conn:
+            try:
+                cur = conn.execute("SELECT term, idf, doc_count, term_count FROM tfidf_vocab")
+                self._vocab = {row["term"]: (row["idf"], row["doc_count"], row["term_count"]) for row in cur}
+            except sqlite3.OperationalError:
+                pass
+            # Trigram -> node names, for find_similar_nodes without FTS5
+            trigrams: dict[str, set[str]] = {}
+            try:
+                for (node_name,) in conn.execute("SELECT DISTINCT name FROM nodes"):
+                    for gram in _trigrams(node_name):
+                        trigrams.setdefault(gram, set()).add(node_name)
+            except sqlite3.OperationalError:
+                pass
+            self._trigrams = trigrams
 
     # ── Metadata ──────────────────────────────────────────────────────────────
 
-    def _get_meta(self, key: str) -> Optional[str]:
-        cur = self._conn.execute("SELECT value FROM graph_metadata WHERE key = ?", (key,))
-        row = cur.fetchone()
-        return row["value"] if row else None
+    def _get_metas(self, conn: sqlite3.Connection, *keys: str) -> dict[str, str]:
+        cur = conn.execute(_SQL_GET_METAS.format(",".join("?" * len(keys))), keys)
+        return {row["key"]: row["value"] for row in cur}
 
     def _set_meta(self, key: str, value: str) -> None:
-        self._conn.execute(
-            "INSERT INTO graph_metadata(key, value) VALUES(?,?) "
-            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-            (key, value),
-        )
-        self._conn.commit()
+        with self.writer() as conn:
+            conn.execute(_SQL_SET_META, (key, value))
+            conn.commit()
 
     # ── Seed node ─────────────────────────────────────────────────────────────
 
-    def _find_seed_node(self, query: str, seed_node_name: Optional[str] = None) -> Optional[str]:
+    def _find_seed_node(
+        self, conn: sqlite3.Connection, query: str, seed_node_name: Optional[str] = None
+    ) -> Optional[str]:
         if seed_node_name:
-            cur = self._conn.execute("SELECT node_id FROM nodes WHERE name = ? LIMIT 1", (seed_node_name,))
+            cur = conn.execute(_SQL_FIND_BY_NAME, (seed_node_name,))
             row = cur.fetchone()
             if row:
                 return row["node_id"]
 
-        # FTS5
+        # FTS5 (BM25-ranked inside SQLite). Terms are quoted so tokens such as
+        # "pkg.fn" are matched as phrases rather than parsed as FTS syntax.
         try:
             tokens = _tokenize(query)[:10]
-            fts_query = " OR ".join(tokens)
+            fts_query = " OR ".join(f'"{t}"' for t in tokens)
             if fts_query:
-                cur = self._conn.execute(
+                cur = conn.execute(
                     "SELECT n.node_id FROM nodes_fts f JOIN nodes n ON n.rowid = f.rowid "
                     "WHERE nodes_fts MATCH ? ORDER BY rank LIMIT 1",
                     (fts_query,),
@@ -172,49 +449,52 @@ class SQLiteGraph:
         except sqlite3.OperationalError:
             pass
 
-        # TF-IDF overlap fallback
-        tokens_set = set(_tokenize(query))
-        cur = self._conn.execute("SELECT node_id, name, pagerank FROM nodes ORDER BY pagerank DESC NULLS LAST LIMIT 200")
-        best_score = 0.0
-        best_id: Optional[str] = None
-        for row in cur:
-            overlap = sum(1 for t in _tokenize(row["name"]) if t in tokens_set)
-            score = overlap + (row["pagerank"] or 0)
-            if score > best_score:
-                best_score = score
-                best_id = row["node_id"]
-        if best_id:
-            return best_id
-
         # Highest pagerank
-        cur = self._conn.execute("SELECT node_id FROM nodes ORDER BY pagerank DESC NULLS LAST LIMIT 1")
+        cur = conn.execute("SELECT node_id FROM nodes ORDER BY pagerank DESC NULLS LAST LIMIT 1")
         row = cur.fetchone()
         return row["node_id"] if row else None
 
     # ── BFS ───────────────────────────────────────────────────────────────────
 
-    _BFS_SQL = """
-    WITH RECURSIVE bfs(node_id, depth) AS (
-      SELECT n.node_id, 0
-      FROM   nodes n
-      WHERE  n.node_id = :seed_node
-
-      UNION ALL
-
-      SELECT e.target_id, bfs.depth + 1
-      FROM   edges  e
-      JOIN   bfs    ON e.source_id = bfs.node_id
-      WHERE  bfs.depth < :max_depth
-        AND  NOT EXISTS (
-               SELECT 1 FROM bfs b2 WHERE b2.node_id = e.target_id
-             )
-    )
-    SELECT DISTINCT n.*, bfs.depth
-    FROM   bfs
-    JOIN   nodes n ON n.node_id = bfs.node_id
-    ORDER  BY bfs.depth ASC, n.pagerank DESC
-    LIMIT  :max_nodes
-    """
+    # Level-by-level BFS driven from Python: the recursive CTE had to probe
+    # the whole CTE for every candidate edge to skip visited nodes, which is
+    # quadratic in frontier size. Here each level is one IN-list query and
+    # visited nodes are skipped with a set lookup.
+
+    def _bfs(
+        self, conn: sqlite3.Connection, seed_id: str, max_depth: int, max_nodes: int
+    ) -> tuple[list[sqlite3.Row], list[int]]:
+        depth_of: dict[str, int] = {seed_id: 0}
+        found = [seed_id]
+        frontier = [seed_id]
+        for level in range(1, max_depth + 1):
+            # Whole levels only, so the depth/pagerank cut below is exact
+            if not frontier or len(found) >= max_nodes:
+                break
+            next_frontier: list[str] = []
+            for batch in _batched(frontier):
+                sql = _SQL_BFS_NEIGHBOURS.format(",".join("?" * len(batch)))
+                for target_id, is_node in conn.execute(sql, batch):
+                    if target_id not in depth_of:
+                        depth_of[target_id] = level
+                        next_frontier.append(target_id)
+                        if is_node:
+                            found.append(target_id)
+            frontier = next_frontier
+
+        rows: list[sqlite3.Row] = []
+        for batch in _batched(found):
+            rows.extend(conn.execute(_SQL_BFS_NODES.format(",".join("?" * len(batch))), batch))
+        # depth ASC, then pagerank DESC with NULLs last (as ORDER BY would)
+        rows.sort(
+            key=lambda r: (
+                depth_of[r["node_id"]],
+                r["pagerank"] is None,
+                -(r["pagerank"] or 0.0),
+            )
+        )
+        rows = rows[:max_nodes]
+        return rows, [depth_of[r["node_id"]] for r in rows]
 
     def query_context(
         self,
@@ -224,21 +504,45 @@ class SQLiteGraph:
         max_depth: int = 3,
         max_nodes: int = 80,
     ) -> ContextResult:
-        seed_id = self._find_seed_node(query, seed_node_name)
-
-        if not seed_id:
-            return ContextResult(
-                context_string="# No graph data available.\n",
-                node_ids=[],
-                token_estimate=0,
-                seed_node=None,
-            )
+        key = (query, seed_node_name or "", budget_tokens, max_depth, max_nodes)
+        stamp = self._db_stamp()
+        hit, result = self._cache_get(self._context_cache, key, stamp)
+        if not hit:
+            try:
+                result = self._query_context(query, seed_node_name, budget_tokens, max_depth, max_nodes)
+            except sqlite3.OperationalError:
+                # An export outside rebuild_graph recreated nodes without the
+                # Python-side columns; restore them and retry once
+                self.reload()
+                result = self._query_context(query, seed_node_name, budget_tokens, max_depth, max_nodes)
+            self._cache_put(self._context_cache, key, stamp, result)
+        return result
 
-        cur = self._conn.execute(
-            self._BFS_SQL,
-            {"seed_node": seed_id, "max_depth": max_depth, "max_nodes": max_nodes},
-        )
-        bfs_nodes = [dict(row) for row in cur]
+    def _query_context(
+        self,
+        query: str,
+        seed_node_name: Optional[str],
+        budget_tokens: int,
+        max_depth: int,
+        max_nodes: int,
+    ) -> ContextResult:
+        with self.reader() as conn:
+            try:
+                seed_id = self._find_seed_node(conn, query, seed_node_name)
+            except sqlite3.OperationalError:
+                # No nodes table yet: the graph has not been built
+                seed_id = None
+
+            if not seed_id:
+                return ContextResult(
+                    context_string="# No graph data available.\n",
+                    node_ids=[],
+                    token_estimate=0,
+                    seed_node=None,
+                )
+
+            # sqlite3.Row already supports access by column name; no dict copy
+            bfs_nodes, bfs_depths = self._bfs(conn, seed_id, max_depth, max_nodes)
 
         # Build TF-IDF query vector
         q_tokens = _tokenize(query)
@@ -247,216 +551,248 @@ class SQLiteGraph:
             tf[t] = tf.get(t, 0) + 1
         n = max(len(q_tokens), 1)
         q_vec = {term: (count / n) * self._vocab[term][0] for term, count in tf.items() if term in self._vocab}
-        q_vec_arr = list(q_vec.values())
-
-        # Score
-        scored = []
-        for node in bfs_nodes:
-            sem_score = 0.0
-            if node.get("embedding") and q_vec_arr:
-                try:
-                    emb = json.loads(node["embedding"])
-                    sem_score = _cosine(q_vec_arr, emb[: len(q_vec_arr)])
-                except (json.JSONDecodeError, TypeError):
-                    pass
-            pr = node.get("pagerank") or 0.0
-            tw = node.get("task_weight") or 0.5
-            depth_pen = 1 / (1 + (node.get("depth") or 0) * 0.5)
-            score = 0.4 * sem_score + 0.35 * pr + 0.15 * tw + 0.1 * depth_pen
-            scored.append((score, node))
-
-        scored.sort(key=lambda x: x[0], reverse=True)
-
-        chunks: list[str] = []
-        used_ids: list[str] = []
+        q_vec_arr = np.fromiter(q_vec.values(), dtype=np.float32, count=len(q_vec))
+
+        # Score: stored embeddings are unit length, so stacking them into one
+        # (N, D) matrix makes cosine similarity a single product with the
+        # unit query. Only vectors cut to the query length (or shorter than
+        # it) need rescaling by the norm of the part actually compared.
+        sem = np.zeros(len(bfs_nodes), dtype=np.float32)
+        dim = q_vec_arr.size
+        q_norm = float(np.linalg.norm(q_vec_arr)) if dim else 0.0
+        if q_norm > 0:
+            q_unit = q_vec_arr / q_norm
+            q_prefix_norms = np.sqrt(np.cumsum(q_unit * q_unit))
+            emb_rows: list[int] = []
+            emb_vecs: list[np.ndarray] = []
+            emb_scales: list[float] = []
+            for i, node in enumerate(bfs_nodes):
+                if node["embedding_blob"] is not None:
+                    emb = np.frombuffer(node["embedding_blob"], dtype=np.float32)
+                elif node["embedding"]:
+                    # Written (or rewritten) since the last migration
+                    emb = _unit_embedding(node["embedding"])
+                    if emb is None:
+                        continue
+                else:
+                    continue
+                if not emb.size:
+                    continue
+                if emb.size > dim:
+                    emb = emb[:dim]
+                    scale = float(np.sqrt(np.vdot(emb, emb)))
+                elif emb.size < dim:
+                    scale = float(q_prefix_norms[emb.size - 1])
+                    emb = np.pad(emb, (0, dim - emb.size))
+                else:
+                    scale = 1.0
+                emb_rows.append(i)
+                emb_vecs.append(emb)
+                emb_scales.append(scale)
+            if emb_vecs:
+                scales = np.asarray(emb_scales, dtype=np.float32)
+                sem[emb_rows] = (np.stack(emb_vecs) @ q_unit) / (scales + 1e-12)
+
+        n_nodes = len(bfs_nodes)
+        pr = np.fromiter((node["pagerank"] or 0.0 for node in bfs_nodes), dtype=np.float64, count=n_nodes)
+        tw = np.fromiter((node["task_weight"] or 0.5 for node in bfs_nodes), dtype=np.float64, count=n_nodes)
+        depth = np.asarray(bfs_depths, dtype=np.float64)
+        scores = _score(sem.astype(np.float64), pr, tw, depth)
+        # Stable on ties, matching the previous list.sort(reverse=True)
+        ranked = [bfs_nodes[i] for i in np.argsort(-scores, kind="stable")]
+
+        # Find the budget cutoff from field lengths, then format only the
+        # nodes that fit
         used_tokens = 0
-
-        for _, node in scored:
-            chunk = self._format_node(node)
-            ct = _estimate_tokens(chunk)
+        n_used = 0
+        for node in ranked:
+            ct = _estimate_node_tokens(node)
             if used_tokens + ct > budget_tokens:
                 break
-            chunks.append(chunk)
-            used_ids.append(node["node_id"])
             used_tokens += ct
+            n_used += 1
+        accepted = ranked[:n_used]
+        used_ids = [node["node_id"] for node in accepted]
+
+        # All node lines go into one flat list joined once at the end
+        out: list[str] = []
+        for i, node in enumerate(accepted):
+            if i:
+                out.append("---")
+            self._format_node(node, out)
 
         header = f"# rrlmgraph context\n# Query: {query}\n# Nodes: {len(used_ids)} | Tokens: ~{used_tokens}\n\n"
         return ContextResult(
-            context_string=header + "\n---\n".join(chunks),
+            context_string=header + "\n".join(out),
             node_ids=used_ids,
             token_estimate=used_tokens,
             seed_node=seed_id,
         )
 
-    def _format_node(self, node: dict) -> str:
-        lines = []
-        ntype = node.get("node_type") or "node"
-        file_ = f" [{node['file']}]" if node.get("file") else ""
-        lines.append(f"## {node['name']}  <{ntype}>{file_}")
-        if node.get("signature"):
-            lines.append(f"**Signature**: `{node['signature']}`")
-        if node.get("roxygen_text"):
-            lines.append("**Documentation**:")
-            lines.append(node["roxygen_text"][:400])
-        if node.get("body_text"):
-            lines.append("```r")
-            lines.append(node["body_text"][:1200])
-            lines.append("```")
-        return "\n".join(lines)
+    # Layout must stay in sync with _estimate_node_tokens
+    def _format_node(self, node: sqlite3.Row, out: list[str]) -> None:
+        # One string per node; each optional section carries its own leading newline
+        file_ = f" [{node['file']}]" if node["file"] else ""
+        sig = f"\n**Signature**: `{node['signature']}`" if node["signature"] else ""
+        doc = f"\n**Documentation**:\n{node['roxygen_text'][:400]}" if node["roxygen_text"] else ""
+        body = f"\n```r\n{node['body_text'][:1200]}\n```" if node["body_text"] else ""
+        out.append(f"## {node['name']}  <{node['node_type'] or 'node'}>{file_}{sig}{doc}{body}")
 
     # ── getNodeInfo ───────────────────────────────────────────────────────────
 
     def get_node_info(self, node_name: str, include_source: bool = False) -> Optional[NodeInfo]:
-        cur = self._conn.execute("SELECT * FROM nodes WHERE name = ? LIMIT 1", (node_name,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        node = dict(row)
-        node_id = node["node_id"]
-
-        callers = [
-            r["name"]
-            for r in self._conn.execute(
-                "SELECT n.name FROM edges e JOIN nodes n ON n.node_id = e.source_id "
-                "WHERE e.target_id = ? AND e.edge_type = 'CALLS' LIMIT 20",
-                (node_id,),
-            )
-        ]
-        callees = [
-            r["name"]
-            for r in self._conn.execute(
-                "SELECT n.name FROM edges e JOIN nodes n ON n.node_id = e.target_id "
-                "WHERE e.source_id = ? AND e.edge_type = 'CALLS' LIMIT 20",
-                (node_id,),
-            )
-        ]
-        tests = [
-            r["name"]
-            for r in self._conn.execute(
-                "SELECT n.name FROM edges e JOIN nodes n ON n.node_id = e.source_id "
-                "WHERE e.target_id = ? AND e.edge_type = 'TESTS' LIMIT 20",
-                (node_id,),
+        key = (node_name, include_source)
+        stamp = self._db_stamp()
+        hit, info = self._cache_get(self._node_cache, key, stamp)
+        if not hit:
+            info = self._get_node_info(node_name, include_source)
+            self._cache_put(self._node_cache, key, stamp, info)
+        return info
+
+    def _get_node_info(self, node_name: str, include_source: bool) -> Optional[NodeInfo]:
+        with self.reader() as conn:
+            cur = conn.execute(_SQL_NODE_BY_NAME, (node_name,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            node = dict(row)
+            node_id = node["node_id"]
+
+            edges: dict[str, list[str]] = {"caller": [], "callee": [], "test": []}
+            for r in conn.execute(_SQL_NODE_EDGES, {"node_id": node_id}):
+                edges[r["kind"]].append(r["name"])
+            callers, callees, tests = edges["caller"], edges["callee"], edges["test"]
+
+            return NodeInfo(
+                node_id=node_id,
+                name=node["name"],
+                file=node.get("file"),
+                node_type=node.get("node_type"),
+                signature=node.get("signature"),
+                body_text=node.get("body_text") if include_source else None,
+                roxygen_text=node.get("roxygen_text"),
+                complexity=node.get("complexity"),
+                pagerank=node.get("pagerank"),
+                task_weight=node.get("task_weight"),
+                pkg_name=node.get("pkg_name"),
+                pkg_version=node.get("pkg_version"),
+                callers=callers,
+                callees=callees,
+                tests=tests,
             )
-        ]
-
-        return NodeInfo(
-            node_id=node_id,
-            name=node["name"],
-            file=node.get("file"),
-            node_type=node.get("node_type"),
-            signature=node.get("signature"),
-            body_text=node.get("body_text") if include_source else None,
-            roxygen_text=node.get("roxygen_text"),
-            complexity=node.get("complexity"),
-            pagerank=node.get("pagerank"),
-            task_weight=node.get("task_weight"),
-            pkg_name=node.get("pkg_name"),
-            pkg_version=node.get("pkg_version"),
-            callers=callers,
-            callees=callees,
-            tests=tests,
-        )
 
     def find_similar_nodes(self, name: str, limit: int = 5) -> list[str]:
         tokens = _tokenize(name)
         if not tokens:
             return []
-        try:
-            fts_query = " OR ".join(f"{t}*" for t in tokens)
-            cur = self._conn.execute(
-                "SELECT n.name FROM nodes_fts f JOIN nodes n ON n.rowid = f.rowid "
-                "WHERE nodes_fts MATCH ? LIMIT ?",
-                (fts_query, limit),
-            )
-            return [r["name"] for r in cur]
-        except sqlite3.OperationalError:
-            return []
+        with self.reader() as conn:
+            try:
+                fts_query = " OR ".join(f'"{t}"*' for t in tokens)
+                cur = conn.execute(
+                    "SELECT n.name FROM nodes_fts f JOIN nodes n ON n.rowid = f.rowid "
+                    "WHERE nodes_fts MATCH ? LIMIT ?",
+                    (fts_query, limit),
+                )
+                similar = [r["name"] for r in cur]
+                if similar:
+                    return similar
+            except sqlite3.OperationalError:
+                pass
+
+        # No FTS5 (or no prefix hit, e.g. a typo): rank names by shared trigrams
+        counts: dict[str, int] = {}
+        for gram in _trigrams(name):
+            for candidate in self._trigrams.get(gram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        ranked = sorted(counts, key=lambda c: (-counts[c], abs(len(c) - len(name)), c))
+        return ranked[:limit]
 
     # ── getGraphSummary ───────────────────────────────────────────────────────
 
     def get_graph_summary(self) -> GraphSummary:
-        node_count = self._conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
-        edge_count = self._conn.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
-
-        node_types: dict[str, int] = {
-            row[0] or "unknown": row[1]
-            for row in self._conn.execute("SELECT node_type, COUNT(*) FROM nodes GROUP BY node_type")
-        }
-        edge_types: dict[str, int] = {
-            row[0] or "unknown": row[1]
-            for row in self._conn.execute("SELECT edge_type, COUNT(*) FROM edges GROUP BY edge_type")
-        }
-        top_hubs = [
-            {"name": row[0], "pagerank": row[1] or 0.0}
-            for row in self._conn.execute(
-                "SELECT name, pagerank FROM nodes ORDER BY pagerank DESC NULLS LAST LIMIT 10"
+        with self.reader() as conn:
+            # Totals are the sums of the per-type counts
+            node_count = edge_count = 0
+            node_types: dict[str, int] = {}
+            edge_types: dict[str, int] = {}
+            for table, type_, count in conn.execute(_SQL_TYPE_COUNTS):
+                if table == "node":
+                    node_count += count
+                    node_types[type_ or "unknown"] = count
+                else:
+                    edge_count += count
+                    edge_types[type_ or "unknown"] = count
+            top_hubs = [
+                {"name": row[0], "pagerank": row[1] or 0.0}
+                for row in conn.execute(
+                    "SELECT name, pagerank FROM nodes ORDER BY pagerank DESC NULLS LAST LIMIT 10"
+                )
+            ]
+            meta = self._get_metas(conn, "build_time", "rrlmgraph_version", "embed_method", "project_root")
+            return GraphSummary(
+                node_count=node_count,
+                edge_count=edge_count,
+                node_types=node_types,
+                edge_types=edge_types,
+                top_hubs=top_hubs,
+                build_time=meta.get("build_time"),
+                rrlmgraph_version=meta.get("rrlmgraph_version"),
+                embed_method=meta.get("embed_method"),
+                project_root=meta.get("project_root"),
             )
-        ]
-        return GraphSummary(
-            node_count=node_count,
-            edge_count=edge_count,
-            node_types=node_types,
-            edge_types=edge_types,
-            top_hubs=top_hubs,
-            build_time=self._get_meta("build_time"),
-            rrlmgraph_version=self._get_meta("rrlmgraph_version"),
-            embed_method=self._get_meta("embed_method"),
-            project_root=self._get_meta("project_root"),
-        )
 
     # ── getFileNodes ──────────────────────────────────────────────────────────
 
     def get_file_nodes(self, file_path: str) -> list[NodeInfo]:
-        decoded = file_path  # assumed already decoded
-        rows = self._conn.execute(
-            "SELECT * FROM nodes WHERE file = ? OR file LIKE ?",
-            (decoded, f"%{decoded}"),
-        )
-        result = []
-        for row in rows:
-            r = dict(row)
-            result.append(
-                NodeInfo(
-                    node_id=r["node_id"],
-                    name=r["name"],
-                    file=r.get("file"),
-                    node_type=r.get("node_type"),
-                    signature=r.get("signature"),
-                    body_text=r.get("body_text"),
-                    roxygen_text=r.get("roxygen_text"),
-                    complexity=r.get("complexity"),
-                    pagerank=r.get("pagerank"),
-                    task_weight=r.get("task_weight"),
-                    pkg_name=r.get("pkg_name"),
-                    pkg_version=r.get("pkg_version"),
+        with self.reader() as conn:
+            decoded = file_path  # assumed already decoded
+            rows = conn.execute(_SQL_FILE_NODES, (decoded, f"%{decoded}"))
+            result = []
+            for row in rows:
+                r = dict(row)
+                result.append(
+                    NodeInfo(
+                        node_id=r["node_id"],
+                        name=r["name"],
+                        file=r.get("file"),
+                        node_type=r.get("node_type"),
+                        signature=r.get("signature"),
+                        body_text=r.get("body_text"),
+                        roxygen_text=r.get("roxygen_text"),
+                        complexity=r.get("complexity"),
+                        pagerank=r.get("pagerank"),
+                        task_weight=r.get("task_weight"),
+                        pkg_name=r.get("pkg_name"),
+                        pkg_version=r.get("pkg_version"),
+                    )
                 )
-            )
-        return result
+            return result
 
     # ── getTaskHistory ────────────────────────────────────────────────────────
 
     def get_task_history(self, max_entries: int = 20) -> list[TaskTrace]:
-        rows = self._conn.execute(
-            "SELECT * FROM task_traces ORDER BY trace_id DESC LIMIT ?", (max_entries,)
-        )
-        result = []
-        for row in rows:
-            r = dict(row)
-            try:
-                nodes = json.loads(r.get("nodes_json") or "[]")
-            except (json.JSONDecodeError, TypeError):
-                nodes = []
-            result.append(
-                TaskTrace(
-                    trace_id=r["trace_id"],
-                    query=r.get("query"),
-                    nodes=nodes,
-                    polarity=r.get("polarity") or 0.0,
-                    session_id=r.get("session_id"),
-                    created_at=r.get("created_at"),
-                )
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT * FROM task_traces ORDER BY trace_id DESC LIMIT ?", (max_entries,)
             )
-        return result
+            result = []
+            for row in rows:
+                r = dict(row)
+                try:
+                    nodes = _json_loads(r.get("nodes_json") or "[]")
+                except (json.JSONDecodeError, TypeError):
+                    nodes = []
+                result.append(
+                    TaskTrace(
+                        trace_id=r["trace_id"],
+                        query=r.get("query"),
+                        nodes=nodes,
+                        polarity=r.get("polarity") or 0.0,
+                        session_id=r.get("session_id"),
+                        created_at=r.get("created_at"),
+                    )
+                )
+            return result
 
     # ── addTaskTrace ──────────────────────────────────────────────────────────
 
@@ -469,17 +805,24 @@ class SQLiteGraph:
     ) -> int:
         if polarity < -1 or polarity > 1:
             raise ValueError(f"polarity must be in [-1, 1], got {polarity}")
-        now = datetime.now(timezone.utc).isoformat()
-        cur = self._conn.execute(
-            "INSERT INTO task_traces(query, nodes_json, polarity, session_id, created_at) "
-            "VALUES(?, ?, ?, ?, ?)",
-            (query, json.dumps(nodes), polarity, session_id, now),
-        )
-        self._conn.commit()
-        return cur.lastrowid  # type: ignore[return-value]
+        with self.writer() as conn:
+            epoch_ms = time.time_ns() // 1_000_000
+            cur = conn.execute(_SQL_INSERT_TRACE, (query, _json_dumps(nodes), polarity, session_id, epoch_ms))
+            conn.commit()
+            return cur.lastrowid  # type: ignore[return-value]
 
     def reload(self) -> None:
+        # The graph may have been re-exported with a fresh nodes table that
+        # lacks the Python-side columns, trigger and indexes
+        self._ensure_schema()
+        self._migrate_embeddings()
         self._load_vocab()
+        with self._cache_lock:
+            self._context_cache.clear()
+            self._node_cache.clear()
 
     def close(self) -> None:
-        self._conn.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        with self._write_lock:
+            self._writer.close()
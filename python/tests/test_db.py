@@ -0,0 +1,186 @@
+"""
+Regression tests for the Python fallback SQLiteGraph.
+
+Builds a small graph from src/db/schema.sql and checks the BFS candidate
+order, the token-budget cutoff and embedding scoring for nodes whose cached
+blob is missing.
+
+Run with:  python -m pytest python/tests
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from db import SQLiteGraph, _SQL_BFS_NODES, _estimate_node_tokens  # noqa: E402
+
+SCHEMA_PATH = Path(__file__).resolve().parents[2] / "src" / "db" / "schema.sql"
+
+# node_id -> (pagerank, embedding)
+#
+#   seed ─┬─> hub  ─┬─> leaf_a
+#         ├─> mid   └─> leaf_b
+#         ├─> nopr
+#         └─> ghost (edge target without a nodes row)
+NODES = {
+    "seed": (0.05, [1.0, -1.0]),
+    "hub": (0.30, [1.0, -1.0]),
+    "mid": (0.20, None),
+    "nopr": (None, None),
+    "leaf_a": (0.10, [0.0, -1.0]),
+    "leaf_b": (0.40, None),
+}
+EDGES = [
+    ("seed", "hub"),
+    ("seed", "mid"),
+    ("seed", "nopr"),
+    ("seed", "ghost"),
+    ("hub", "leaf_a"),
+    ("hub", "leaf_b"),
+]
+
+
+@pytest.fixture
+def db_path(tmp_path: Path) -> Path:
+    path = tmp_path / "graph.sqlite"
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA_PATH.read_text(encoding="utf-8"))
+    for node_id, (pagerank, embedding) in NODES.items():
+        conn.execute(
+            "INSERT INTO nodes(node_id, name, file, node_type, signature, body_text, pagerank, embedding) "
+            "VALUES(?, ?, 'R/graph.R', 'function', ?, ?, ?, ?)",
+            (
+                node_id,
+                node_id,
+                f"{node_id}(x)",
+                f"{node_id} <- function(x) x\n" * 3,
+                pagerank,
+                json.dumps(embedding) if embedding else None,
+            ),
+        )
+    conn.executemany(
+        "INSERT INTO edges(source_id, target_id, edge_type) VALUES(?, ?, 'CALLS')", EDGES
+    )
+    conn.executemany(
+        "INSERT INTO tfidf_vocab(term, idf, doc_count, term_count) VALUES(?, 1.0, 1, 1)",
+        [("read",), ("csv",)],
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def graph(db_path: Path):
+    g = SQLiteGraph(str(db_path), pool_size=2)
+    yield g
+    g.close()
+
+
+def _bfs_ids(graph: SQLiteGraph, max_depth: int, max_nodes: int) -> tuple[list[str], list[int]]:
+    with graph.reader() as conn:
+        rows, depths = graph._bfs(conn, "seed", max_depth, max_nodes)
+    return [r["node_id"] for r in rows], depths
+
+
+def _node_tokens(graph: SQLiteGraph, node_ids: list[str]) -> list[int]:
+    with graph.reader() as conn:
+        rows = {
+            r["node_id"]: r
+            for r in conn.execute(_SQL_BFS_NODES.format(",".join("?" * len(node_ids))), node_ids)
+        }
+    return [_estimate_node_tokens(rows[node_id]) for node_id in node_ids]
+
+
+# ── BFS ───────────────────────────────────────────────────────────────────────
+
+
+def test_bfs_orders_by_depth_then_pagerank(graph: SQLiteGraph) -> None:
+    ids, depths = _bfs_ids(graph, max_depth=3, max_nodes=80)
+    # NULL pagerank sorts last within its level; the dangling target is skipped
+    assert ids == ["seed", "hub", "mid", "nopr", "leaf_b", "leaf_a"]
+    assert depths == [0, 1, 1, 1, 2, 2]
+
+
+def test_bfs_respects_max_depth(graph: SQLiteGraph) -> None:
+    ids, depths = _bfs_ids(graph, max_depth=1, max_nodes=80)
+    assert ids == ["seed", "hub", "mid", "nopr"]
+    assert depths == [0, 1, 1, 1]
+
+
+def test_bfs_truncates_to_max_nodes(graph: SQLiteGraph) -> None:
+    # The cut keeps the highest-pagerank nodes of the last level reached,
+    # and the dangling edge target does not take up a slot
+    ids, _ = _bfs_ids(graph, max_depth=3, max_nodes=3)
+    assert ids == ["seed", "hub", "mid"]
+
+
+# ── Token budget ──────────────────────────────────────────────────────────────
+
+
+def test_node_token_estimate_matches_formatted_text(graph: SQLiteGraph) -> None:
+    result = graph.query_context("read csv", "seed", budget_tokens=100_000)
+    estimates = _node_tokens(graph, result.node_ids)
+    assert result.token_estimate == sum(estimates)
+    # Each block rendered by _format_node is what the estimate accounts for
+    blocks = result.context_string.split("\n\n", 1)[1].split("\n---\n")
+    assert len(blocks) == len(result.node_ids)
+    for block, tokens in zip(blocks, estimates):
+        assert tokens == max(1, math.ceil(len(block) / 3.5))
+
+
+def test_budget_cuts_off_at_first_node_that_does_not_fit(graph: SQLiteGraph) -> None:
+    ranked = graph.query_context("read csv", "seed", budget_tokens=100_000).node_ids
+    first, second = _node_tokens(graph, ranked[:2])
+
+    result = graph.query_context("read csv", "seed", budget_tokens=first + second)
+    assert result.node_ids == ranked[:2]
+    assert result.token_estimate == first + second
+
+    result = graph.query_context("read csv", "seed", budget_tokens=first + second - 1)
+    assert result.node_ids == ranked[:1]
+    assert result.token_estimate == first
+
+
+# ── Embedding scoring ─────────────────────────────────────────────────────────
+
+
+def test_node_inserted_after_startup_is_scored_from_json(graph: SQLiteGraph, db_path: Path) -> None:
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "INSERT INTO nodes(node_id, name, node_type, pagerank, embedding) "
+        "VALUES('fresh', 'fresh', 'function', 0.0, '[2.0, 2.0]')"
+    )
+    conn.execute("INSERT INTO edges(source_id, target_id, edge_type) VALUES('seed', 'fresh', 'CALLS')")
+    conn.commit()
+    assert conn.execute("SELECT embedding_blob FROM nodes WHERE node_id = 'fresh'").fetchone() == (None,)
+    conn.close()
+
+    # Aligned with the query, so it outranks every higher-pagerank neighbour
+    live = graph.query_context("read csv", "seed", budget_tokens=100_000)
+    assert live.node_ids[0] == "fresh"
+
+    graph.reload()
+    assert graph.query_context("read csv", "seed", budget_tokens=100_000) == live
+
+
+def test_in_place_embedding_update_resets_blob(graph: SQLiteGraph, db_path: Path) -> None:
+    before = graph.query_context("read csv", "seed", budget_tokens=100_000)
+    assert before.node_ids[0] != "leaf_a"
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE nodes SET embedding = '[1.0, 1.0]' WHERE node_id = 'leaf_a'")
+    conn.commit()
+    assert conn.execute("SELECT embedding_blob FROM nodes WHERE node_id = 'leaf_a'").fetchone() == (None,)
+    conn.close()
+
+    after = graph.query_context("read csv", "seed", budget_tokens=100_000)
+    assert after.node_ids[0] == "leaf_a"